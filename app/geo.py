@@ -0,0 +1,44 @@
+# app/geo.py
+
+import numpy as np
+
+# Routes shorter than this are cheap to draw as-is.
+SIMPLIFY_MIN_POINTS = 200
+
+def simplify_polyline(points, epsilon: float = 1e-5) -> np.ndarray:
+    """
+    Reduces a polyline with Ramer-Douglas-Peucker, keeping every point that deviates
+    from the simplified line by more than epsilon (in coordinate units; 1e-5 deg is ~1 m).
+    Iterative with an explicit stack, and vectorized per segment, so long routes don't recurse.
+    """
+    pts = np.asarray(points, dtype=np.float64)
+    n = len(pts)
+    if n < SIMPLIFY_MIN_POINTS:
+        return pts
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        segment = pts[end] - pts[start]
+        inner = pts[start + 1:end] - pts[start]
+        seg_len = np.hypot(segment[0], segment[1])
+        if seg_len == 0.0:
+            dists = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            # Perpendicular distance from each inner point to the start-end chord.
+            dists = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / seg_len
+
+        idx = int(np.argmax(dists))
+        if dists[idx] > epsilon:
+            split = start + 1 + idx
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return pts[keep]
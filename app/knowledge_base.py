@@ -1,11 +1,11 @@
 # app/knowledge_base.py
 
 import os
+from datetime import datetime, timedelta, timezone
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Sequence
 import streamlit as st
-import faiss
 import pickle
 import numpy as np
 
@@ -30,11 +30,28 @@ def get_db_client():
         st.error(f"MongoDB connection failed: {e}. Please check your connection string and network access.")
         return None
 
+@st.cache_resource
+def get_faiss_gpu_resources():
+    """Holds the FAISS GPU resources for the life of the process, as the GPU index requires."""
+    import faiss
+    return faiss.StandardGpuResources()
+
 @st.cache_resource
 def load_faiss_index():
-    """Loads the FAISS index from the specified file."""
+    """
+    Loads the FAISS index from the specified file.
+    faiss is imported here so app start-up doesn't pay for it before the first search.
+    RAG_INDEX_BACKEND=gpu moves the index onto the first GPU when a GPU build of faiss is installed.
+    """
     try:
-        return faiss.read_index("faiss_index.bin")
+        import faiss
+        index = faiss.read_index("faiss_index.bin")
+        if os.getenv("RAG_INDEX_BACKEND", "cpu") == "gpu":
+            if hasattr(faiss, "StandardGpuResources"):
+                index = faiss.index_cpu_to_gpu(get_faiss_gpu_resources(), 0, index)
+            else:
+                st.warning("RAG_INDEX_BACKEND=gpu needs faiss-gpu; using the CPU index.")
+        return index
     except Exception as e:
         st.error(f"Failed to load FAISS index from 'faiss_index.bin': {e}")
         return None
@@ -53,62 +70,60 @@ def load_knowledge_base_texts():
         return []
 
 # --- Point of Interest (POI) Functions ---
+# A city's POIs are fetched once an hour as one shared bundle; the sidebar's tag and budget
+# filters, and its option lists, are computed from that bundle in memory.
+
+BUDGET_SORT_ORDER = {'free': 0, 'low': 1, 'medium': 2, 'high': 3}
 
-def get_pois_by_city(city: str, tags: List[str] = None, budget: str = None) -> List[Dict]:
+@st.cache_resource(ttl=3600, show_spinner=False)
+def get_city_pois(city: str) -> List[Dict]:
     """
-    Fetches POIs for a given city, with optional filtering by tags and budget.
+    Fetches every POI document for a given city.
+    The list is shared by every session without copying, so callers must treat it as read-only.
     Returns an empty list if the database client is unavailable.
     """
     client = get_db_client()
     if not client: return []
     db = client["Hackathon_Project"]
+    return list(db["NSK_AI"].find({"city": city}))
 
-    query = {"city": city}
-    if tags:
-        query["tags"] = {"$all": tags} # Use $all for more precise tag matching
-    if budget and budget != "Any":
-        query["budget_level"] = budget
+def _poi_tags(poi: Dict) -> Sequence[str]:
+    """Returns a POI's tags as a sequence, tolerating a missing or null field and a single tag stored as a string."""
+    tags = poi.get("tags") or ()
+    return (tags,) if isinstance(tags, str) else tags
 
-    cursor = db["NSK_AI"].find(query, {"name": 1, "_id": 1})
-    return list(cursor)
-
-def get_poi_by_id(poi_id: str) -> Dict[str, Any]:
+def get_pois_by_city(city: str, tags: Sequence[str] = None, budget: str = None) -> List[Dict]:
     """
-    Fetches a single, complete POI document by its ID.
-    Returns None if the database client is unavailable or POI is not found.
+    Returns the city's POIs that carry all of the given tags and match the budget level.
+    Filters the cached city bundle, so changing filters never queries the database.
     """
-    client = get_db_client()
-    if not client: return None
-    db = client["Hackathon_Project"]
-    return db["NSK_AI"].find_one({"_id": poi_id})
+    required_tags = set(tags or ())
+    return [
+        poi for poi in get_city_pois(city)
+        if (not budget or budget == "Any" or poi.get("budget_level") == budget)
+        and required_tags.issubset(_poi_tags(poi))
+    ]
 
 def get_unique_tags_by_city(city: str) -> List[str]:
-    """
-    Fetches a list of all unique tags for a given city.
-    Returns an empty list if the database client is unavailable.
-    """
-    client = get_db_client()
-    if not client: return []
-    db = client["Hackathon_Project"]
-    return db["NSK_AI"].distinct("tags", {"city": city})
+    """Returns the sorted unique tags across a city's POIs."""
+    return sorted({tag for poi in get_city_pois(city) for tag in _poi_tags(poi)})
 
 def get_unique_budgets_by_city(city: str) -> List[str]:
-    """
-    Fetches a list of all unique budget levels for a given city.
-    Returns an empty list if the database client is unavailable.
-    """
-    client = get_db_client()
-    if not client: return []
-    db = client["Hackathon_Project"]
-    budgets = db["NSK_AI"].distinct("budget_level", {"city": city})
-    # Define a sort order to ensure consistent presentation
-    sort_order = {'free': 0, 'low': 1, 'medium': 2, 'high': 3}
-    return sorted(budgets, key=lambda x: sort_order.get(x, 99))
+    """Returns the unique budget levels across a city's POIs, cheapest first."""
+    budgets = {poi["budget_level"] for poi in get_city_pois(city) if isinstance(poi.get("budget_level"), str) and poi["budget_level"]}
+    return sorted(budgets, key=lambda x: BUDGET_SORT_ORDER.get(x, 99))
 
 # --- Vector Search / RAG Functions ---
 
-def search_knowledge_base(query_embedding: np.ndarray, k: int = 5) -> str:
-    """Searches the FAISS index for the most relevant text chunks."""
+# Roughly 1,500 tokens; keeps the narrative prompt (and LLM latency) flat as the knowledge base grows.
+MAX_CONTEXT_CHARS = 6000
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+
+def search_knowledge_base(query_embedding: np.ndarray, k: int = RAG_TOP_K, max_chars: int = MAX_CONTEXT_CHARS) -> str:
+    """
+    Searches the FAISS index for the most relevant text chunks.
+    Chunks are added best-first until the character budget is used up.
+    """
     faiss_index = load_faiss_index()
     knowledge_base_texts = load_knowledge_base_texts()
 
@@ -116,7 +131,16 @@ def search_knowledge_base(query_embedding: np.ndarray, k: int = 5) -> str:
         return "Knowledge base is currently unavailable."
 
     distances, indices = faiss_index.search(query_embedding, k)
-    retrieved_chunks = [knowledge_base_texts[i] for i in indices[0]]
+    retrieved_chunks = []
+    used_chars = 0
+    for i in indices[0]:
+        if i < 0:
+            break # FAISS pads with -1 when k exceeds the number of stored vectors.
+        chunk = knowledge_base_texts[i]
+        if retrieved_chunks and used_chars + len(chunk) > max_chars:
+            break
+        retrieved_chunks.append(chunk[:max_chars])
+        used_chars += len(chunk)
     context = "\n\n---\n\n".join(retrieved_chunks)
     return context
 
@@ -149,3 +173,88 @@ def update_user_preferences(user_id: str, new_preferences: Dict[str, List[str]])
         upsert=True
 )
     
+
+# --- Feedback Event Functions ---
+
+def append_feedback(event: Dict[str, Any]):
+    """
+    Appends a single feedback event; preference reflection consumes them later in batches.
+    Does nothing if the database client is unavailable.
+    """
+    client = get_db_client()
+    if not client:
+        st.warning("Database connection is unavailable. Feedback not saved.")
+        return
+    db = client["Hackathon_Project"]
+    db["feedback"].insert_one({**event, "processed": False, "created_at": datetime.now(timezone.utc)})
+
+def _due_feedback_filter() -> Dict[str, Any]:
+    """Matches unprocessed events that are neither dead-lettered nor still backing off after a failure."""
+    return {
+        "processed": False,
+        "dead_letter": {"$ne": True},
+        "$or": [{"retry_after": {"$exists": False}}, {"retry_after": {"$lte": datetime.now(timezone.utc)}}],
+    }
+
+def get_pending_feedback(user_id: str, limit: int = 20) -> List[Dict]:
+    """
+    Fetches a user's oldest feedback events that are due for reflection.
+    Returns an empty list if the database client is unavailable.
+    """
+    client = get_db_client()
+    if not client: return []
+    db = client["Hackathon_Project"]
+    cursor = db["feedback"].find({"user_id": user_id, **_due_feedback_filter()}).sort("created_at", 1).limit(limit)
+    return list(cursor)
+
+def mark_feedback_processed(feedback_ids: List[Any]):
+    """
+    Flags feedback events as folded into the user's preferences.
+    Does nothing if the database client is unavailable.
+    """
+    client = get_db_client()
+    if not client: return
+    db = client["Hackathon_Project"]
+    db["feedback"].update_many({"_id": {"$in": feedback_ids}}, {"$set": {"processed": True}})
+
+def record_feedback_failure(events: List[Dict], max_attempts: int, retry_base_seconds: float):
+    """
+    Counts a failed reflection against its events and backs them off exponentially;
+    events that reach max_attempts are dead-lettered and never retried.
+    Does nothing if the database client is unavailable.
+    """
+    client = get_db_client()
+    if not client: return
+    db = client["Hackathon_Project"]
+    feedback_ids = [event["_id"] for event in events]
+    attempts = max(event.get("attempts", 0) for event in events) + 1
+    now = datetime.now(timezone.utc)
+    db["feedback"].update_many(
+        {"_id": {"$in": feedback_ids}},
+        {"$inc": {"attempts": 1},
+         "$set": {"last_failed_at": now, "retry_after": now + timedelta(seconds=retry_base_seconds * 2 ** (attempts - 1))}}
+    )
+    db["feedback"].update_many(
+        {"_id": {"$in": feedback_ids}, "attempts": {"$gte": max_attempts}},
+        {"$set": {"dead_letter": True}}
+    )
+
+def count_pending_feedback(user_id: str) -> int:
+    """
+    Counts a user's feedback events that are due for reflection.
+    Returns 0 if the database client is unavailable.
+    """
+    client = get_db_client()
+    if not client: return 0
+    db = client["Hackathon_Project"]
+    return db["feedback"].count_documents({"user_id": user_id, **_due_feedback_filter()})
+
+def get_users_with_pending_feedback() -> List[str]:
+    """
+    Lists the users that have feedback events due for reflection.
+    Returns an empty list if the database client is unavailable.
+    """
+    client = get_db_client()
+    if not client: return []
+    db = client["Hackathon_Project"]
+    return db["feedback"].distinct("user_id", _due_feedback_filter())
@@ -1,6 +1,9 @@
+from dataclasses import dataclass
 from pydantic import BaseModel, Field
 from typing import List, Optional
 
+import numpy as np
+
 # ==============================================================================
 # 1. Models for Incoming API Requests
 # ==============================================================================
@@ -70,4 +73,18 @@ class ReflectionRequest(BaseModel):
     user_feedback: str = Field(description="The user's feedback, e.g., 'liked' or 'disliked'.")
 
 
-    
+# ==============================================================================
+# 5. Internal Data Structures
+# ==============================================================================
+
+@dataclass(frozen=True, slots=True, eq=False)
+class RouteSummary:
+    """
+    A route as the app uses it, extracted once from the OpenRouteService response.
+    A plain slotted dataclass rather than a Pydantic model: it is built from trusted
+    API data and read on every rerun, so it skips validation and per-instance dicts.
+    Compared by identity, since the generated __eq__ would compare the points array ambiguously.
+    """
+    duration_min: float
+    distance_km: float
+    points: np.ndarray # (n, 2) array of [lon, lat] pairs, in ORS order.
@@ -0,0 +1,45 @@
+# app/narrative_cache.py
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+def normalize_query(query: str) -> str:
+    """Lowercases a query, drops punctuation and collapses whitespace, so trivially different phrasings share a key."""
+    text = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(text.split())
+
+class NarrativeCache:
+    """
+    A thread-safe LRU cache whose entries expire after ttl seconds.
+    Holds finished narratives so repeating a journey skips the embedding, search and LLM call.
+    """
+
+    def __init__(self, capacity: int = 1000, ttl: float = 3600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns the cached value, or None if it is missing or has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """Stores a value, evicting the least recently used entries past capacity."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
@@ -1,32 +1,54 @@
 # app/services.py
 
 import os
+import functools
+import logging
+import string
+import textwrap
 import httpx
 import numpy as np
-from typing import Dict, List, Optional
-import json
+from typing import Callable, Dict, Iterator, List, Optional
+import orjson
 
-from dotenv import load_dotenv
+from pydantic import ValidationError
+from langchain_core.utils.json import parse_partial_json
 import streamlit as st
 
 from . import models
 from . import knowledge_base
 
+logger = logging.getLogger(__name__)
+
 # --- Routing Service Function ---
 
-def get_route_from_ors(start_lon: float, start_lat: float, end_lon: float, end_lat: float, travel_mode: str = "foot-walking") -> Optional[Dict]:
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """
+    Creates and caches one HTTP client for all routing calls.
+    HTTP/2 and compressed responses keep the large route geometries cheap on the wire.
+    """
+    return httpx.Client(
+        http2=True,
+        headers={"Accept-Encoding": "gzip, br"},
+        # A short connect timeout fails fast when ORS is unreachable; reads keep the full budget for long routes.
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+    )
+
+def get_route_from_ors(start_lon: float, start_lat: float, end_lon: float, end_lat: float, travel_mode: str = "foot-walking") -> Optional[models.RouteSummary]:
     """
     Fetches route data from OpenRouteService API for a given travel mode.
-    Returns the route data dictionary on success, or None if no route is found.
+    Returns a RouteSummary on success, or None if no route is found.
     """
     ORS_API_KEY = os.getenv("ORS_API_KEY")
-    ors_url = f"https://api.openrouteservice.org/v2/directions/{travel_mode}?api_key={ORS_API_KEY}&start={start_lon},{start_lat}&end={end_lon},{end_lat}"
+    ors_url = f"https://api.openrouteservice.org/v2/directions/{travel_mode}"
+    # The key travels in the Authorization header so it never shows up in logged request URLs.
+    params = {"start": f"{start_lon},{start_lat}", "end": f"{end_lon},{end_lat}"}
 
     try:
-        with httpx.Client() as client:
-            response = client.get(ors_url, timeout=30.0)
-            response.raise_for_status()
-            ors_data = response.json()
+        response = get_http_client().get(ors_url, params=params, headers={"Authorization": ORS_API_KEY or ""})
+        response.raise_for_status()
+        ors_data = orjson.loads(response.content)
 
         # --- GRACEFUL FALLBACK LOGIC ---
         # Check if the 'features' list is empty, which means no route was found by the API.
@@ -36,11 +58,11 @@ def get_route_from_ors(start_lon: float, start_lat: float, end_lon: float, end_l
         route_info = ors_data['features'][0]['properties']['segments'][0]
         geometry = ors_data['features'][0]['geometry']['coordinates']
 
-        return {
-            "duration": route_info['duration'],
-            "distance": route_info['distance'],
-            "points": geometry
-        }
+        return models.RouteSummary(
+            duration_min=route_info['duration'] / 60,
+            distance_km=route_info['distance'] / 1000,
+            points=np.asarray(geometry, dtype=np.float64)
+        )
     except httpx.RequestError as e:
         raise Exception(f"Network error calling OpenRouteService: {e}")
     except httpx.HTTPStatusError as e:
@@ -49,104 +71,204 @@ def get_route_from_ors(start_lon: float, start_lat: float, end_lon: float, end_l
         raise Exception(f"Unexpected data format from OpenRouteService. Raw error: {e}")
 
 
-# --- Narrative and Chat Generation Functions ---
-# (The rest of the file remains exactly the same)
+# --- Prompt Templates ---
+# Built and dedented once at import; each call only substitutes its values.
 
-def generate_narrative_with_rag(llm, embedding_model, parser, request: models.JourneyRequest, destination_name: str) -> models.JourneyNarrative:
-    """
-    Generates the primary, personalized journey narrative using a RAG model.
-    """
-    user_prefs = knowledge_base.get_user_preferences(request.user_id)
-    preferences_text = f"This user's known preferences are: Likes: {user_prefs.get('likes', [])}, Dislikes: {user_prefs.get('dislikes', [])}."
-
-    query_embedding = embedding_model.encode(request.query)
-    query_embedding_2d = np.array([query_embedding]).astype('float32')
-    context = knowledge_base.search_knowledge_base(query_embedding_2d)
-
-    prompt = f"""
+NARRATIVE_PROMPT = string.Template(textwrap.dedent("""
     You are a Hometown Atlas, a precise and context-aware AI travel guide
      for African Cities and Cultures.
     Your primary goal is to generate a narrative for a user's journey to a specific destination and enrich the journey with fascinating stories like a tourist guide.
 
     **CRITICAL INSTRUCTIONS:**
-    1.  **STAY LOCAL:** The user is in **{request.city}**. All descriptions, landmarks, and facts MUST be relevant to **{request.city}**.
-    2.  **DESTINATION FOCUS:** The user wants to go to **{destination_name}**. The narrative should be about the journey TO this specific place.
+    1.  **STAY LOCAL:** The user is in **$city**. All descriptions, landmarks, and facts MUST be relevant to **$city**.
+    2.  **DESTINATION FOCUS:** The user wants to go to **$destination**. The narrative should be about the journey TO this specific place.
     3.  **USE THE CONTEXT:** The following 'Retrieved Context' is your primary source of truth. Base your narrative on this information.
-    4.  **FALLBACK PLAN:** If the 'Retrieved Context' is empty or not helpful, generate a rich, interesting description of the destination, **{destination_name}**, itself.
-    5.  **USER PROFILE:** Consider the user's preferences: {preferences_text}.
+    4.  **FALLBACK PLAN:** If the 'Retrieved Context' is empty or not helpful, generate a rich, interesting description of the destination, **$destination**, itself.
+    5.  **USER PROFILE:** Consider the user's preferences: $prefs.
 
-    **User's Goal:** "{request.query}"
+    **User's Goal:** "$query"
     **Retrieved Context from Knowledge Base:**
-    {context}
+    $context
     ---
     Now, generate the narrative based on these strict instructions.
-    {parser.get_format_instructions()}
-    """
-
-    ai_response = llm.invoke(prompt)
-    return parser.parse(ai_response.content)
-
+    """))
 
-def generate_chat_response(llm, user_id: str, city: str, destination_name: str, journey_narrative: models.JourneyNarrative, conversation_history: str) -> str:
-    """
-    Generates a conversational response for the 'Talk with the Guide' tab.
-    """
-    user_prefs = knowledge_base.get_user_preferences(user_id)
-    preferences_text = f"User Likes: {user_prefs.get('likes', [])}, User Dislikes: {user_prefs.get('dislikes', [])}."
-
-    prompt = f"""
-    You are a helpful and conversational AI tour guide for the city of {city}.
-    The user has already generated a journey to "{destination_name}" and is now asking follow-up questions.
+CHAT_PROMPT = string.Template(textwrap.dedent("""
+    You are a helpful and conversational AI tour guide for the city of $city.
+    The user has already generated a journey to "$destination" and is now asking follow-up questions.
     Your personality is friendly, knowledgeable, and concise.
 
     **CONTEXT OF THE CURRENT JOURNEY:**
-    - Title: {journey_narrative.title}
-    - Summary: {journey_narrative.narrative}
-    - User Preferences: {preferences_text}
+    - Title: $title
+    - Summary: $summary
+    - User Preferences: $prefs
 
     **CONVERSATION HISTORY (latest message is from the user):**
-    {conversation_history}
+    $history
 
     **YOUR TASK:**
     Based on the journey context and conversation history, provide a helpful and relevant answer to the user's last message.
     Keep your answers brief and to the point.
-    """
+    """))
 
-    ai_response = llm.invoke(prompt)
-    return ai_response.content
+SUMMARY_PROMPT = string.Template(textwrap.dedent("""
+    You are summarizing a conversation between a traveller and their AI tour guide.
+    Merge the existing summary with the new messages into one short paragraph.
+    Keep the places, preferences and open questions the guide will need later; drop greetings and filler.
 
+    **Existing Summary:** $summary
+    **New Messages:**
+    $messages
 
-def reflect_and_update_preferences(llm, request: models.ReflectionRequest):
-    """Uses an LLM to analyze user feedback and update their preference profile."""
-    current_prefs = knowledge_base.get_user_preferences(request.user_id)
+    Respond ONLY with the updated summary.
+    """))
 
-    reflection_prompt = f"""
+REFLECTION_PROMPT = string.Template(textwrap.dedent("""
     You are a user preference analysis AI. Your job is to update a user's preference profile based on their recent activity.
-    Analyze the interaction below and update the 'likes' and 'dislikes' lists.
-    - Infer general topics from the query and title (e.g., 'quiet walk' -> 'quiet', 'historical tour' -> 'history').
-    - If the user 'liked' the journey, add the inferred topics to their 'likes'.
+    Analyze the interactions below and update the 'likes' and 'dislikes' lists.
+    - Infer general topics from each query and title (e.g., 'quiet walk' -> 'quiet', 'historical tour' -> 'history').
+    - If the user 'liked' a journey, add the inferred topics to their 'likes'.
     - If they 'disliked' it, add the inferred topics to their 'dislikes'.
     - Do not add duplicate items. Keep the lists concise and lowercase.
 
-    **Current User Profile:** {current_prefs}
-    **User's Recent Activity:**
-    - Initial Query: "{request.original_query}"
-    - Journey Title: "{request.journey_title}"
-    - Feedback: "{request.user_feedback}"
+    **Current User Profile:** $current_prefs
+    **User's Recent Activity (oldest first):**
+    $activity
 
     **Your Task:** Respond ONLY with the updated JSON object for the 'preferences' field and nothing else.
-    Example response: {{"likes": ["history", "quiet"], "dislikes": ["crowded"]}}
+    Example response: {"likes": ["history", "quiet"], "dislikes": ["crowded"]}
+    """))
+
+
+# --- Narrative and Chat Generation Functions ---
+
+def embed_query(embedding_model, query: str) -> np.ndarray:
+    """
+    Returns the (1, dim) float32 query matrix FAISS expects, memoized per model and query.
+    MiniLM is uncased, so queries differing only in case or spacing share one entry.
+    """
+    return _cached_query_embedding(embedding_model, " ".join(query.lower().split()))
+
+@functools.lru_cache(maxsize=2048)
+def _cached_query_embedding(embedding_model, normalized_query: str) -> np.ndarray:
+    # Encoding a batch returns the (1, dim) matrix FAISS expects, without an extra copy.
+    # MiniLM ends in a Normalize module, so this is already unit-norm like the indexed vectors.
+    query_embedding = embedding_model.encode([normalized_query], convert_to_numpy=True, show_progress_bar=False)
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    query_embedding.setflags(write=False)  # Shared between callers, so keep it immutable.
+    return query_embedding
+
+def generate_narrative_with_rag(llm, embedding_model, parser, request: models.JourneyRequest, destination_name: str,
+                                on_partial: Optional[Callable[[Dict], None]] = None) -> models.JourneyNarrative:
+    """
+    Generates the primary, personalized journey narrative using a RAG model.
+    With on_partial, the response is streamed and the callback receives the best-effort
+    parse of the JSON received so far; the full narrative is still validated once at the end.
+    """
+    user_prefs = knowledge_base.get_user_preferences(request.user_id)
+    preferences_text = f"This user's known preferences are: Likes: {user_prefs.get('likes', [])}, Dislikes: {user_prefs.get('dislikes', [])}."
+
+    context = knowledge_base.search_knowledge_base(embed_query(embedding_model, request.query))
+
+    prompt = NARRATIVE_PROMPT.substitute(
+        city=request.city, destination=destination_name, prefs=preferences_text,
+        query=request.query, context=context
+    )
+
+    if on_partial is None:
+        ai_response = llm.invoke(prompt)
+        return _parse_narrative(parser, ai_response.content)
+
+    buffer = []
+    for chunk in llm.stream(prompt):
+        buffer.append(chunk.content)
+        partial = parse_partial_json("".join(buffer))
+        if isinstance(partial, dict):
+            on_partial(partial)
+    return _parse_narrative(parser, "".join(buffer))
+
+
+def _parse_narrative(parser, content: str) -> models.JourneyNarrative:
+    """
+    Validates the LLM output straight into a JourneyNarrative, falling back to
+    LangChain's more forgiving parser only when the fast path fails.
+    """
+    cleaned = content.strip().removeprefix("```json").removesuffix("```").strip()
+    try:
+        return models.JourneyNarrative.model_validate_json(cleaned)
+    except ValidationError:
+        return parser.parse(content)
+
+
+def _build_chat_prompt(user_id: str, city: str, destination_name: str, journey_narrative: models.JourneyNarrative, conversation_history: str) -> str:
+    """Fills the chat prompt with the journey context and the user's preferences."""
+    user_prefs = knowledge_base.get_user_preferences(user_id)
+    preferences_text = f"User Likes: {user_prefs.get('likes', [])}, User Dislikes: {user_prefs.get('dislikes', [])}."
+
+    return CHAT_PROMPT.substitute(
+        city=city, destination=destination_name, title=journey_narrative.title,
+        summary=journey_narrative.narrative, prefs=preferences_text, history=conversation_history
+    )
+
+
+def stream_chat_response(llm, user_id: str, city: str, destination_name: str, journey_narrative: models.JourneyNarrative, conversation_history: str) -> Iterator[str]:
+    """
+    Streams the guide's reply token chunk by token chunk, for use with st.write_stream.
     """
+    prompt = _build_chat_prompt(user_id, city, destination_name, journey_narrative, conversation_history)
+    for chunk in llm.stream(prompt):
+        yield chunk.content
 
-    ai_response = llm.invoke(reflection_prompt)
 
+def summarize_history(llm, previous_summary: str, messages: List[Dict[str, str]]) -> str:
+    """
+    Folds older chat messages into the running conversation summary with one LLM call,
+    so the chat prompt carries a fixed-size digest instead of the whole transcript.
+    """
+    prompt = SUMMARY_PROMPT.substitute(
+        summary=previous_summary or "None yet.",
+        messages="\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    )
+    return llm.invoke(prompt).content.strip()
+
+
+# Upper bound on feedback events folded into one reflection call.
+FEEDBACK_BATCH_SIZE = 20
+# A failed batch is retried after 1, 2, 4, 8 minutes, then dead-lettered.
+FEEDBACK_MAX_ATTEMPTS = 5
+FEEDBACK_RETRY_BASE_SECONDS = 60
+
+def reflect_on_pending_feedback(llm, user_id: str, batch_size: int = FEEDBACK_BATCH_SIZE):
+    """
+    Folds a user's unprocessed feedback events into their preference profile with a single LLM call.
+    A failed reflection backs its events off and dead-letters them after FEEDBACK_MAX_ATTEMPTS,
+    so a persistent error doesn't cost an LLM call on every flush.
+    Runs off the UI thread, so every failure (database, LLM or parsing) is logged rather than shown.
+    """
+    ai_content = None
+    events = []
     try:
-        cleaned_response = ai_response.content.strip().replace("```json", "").replace("```", "")
-        updated_prefs_data = json.loads(cleaned_response)
+        events = knowledge_base.get_pending_feedback(user_id, limit=batch_size)
+        if not events:
+            return
+
+        current_prefs = knowledge_base.get_user_preferences(user_id)
+        activity = "\n".join(
+            f'- Initial Query: "{event["original_query"]}" | Journey Title: "{event["journey_title"]}" | Feedback: "{event["user_feedback"]}"'
+            for event in events
+        )
+        reflection_prompt = REFLECTION_PROMPT.substitute(current_prefs=current_prefs, activity=activity)
+
+        ai_content = llm.invoke(reflection_prompt).content
+        cleaned_response = ai_content.strip().replace("```json", "").replace("```", "")
+        updated_prefs_data = orjson.loads(cleaned_response)
         validated_prefs = models.UserPreferences(**updated_prefs_data)
-        knowledge_base.update_user_preferences(request.user_id, validated_prefs.dict())
-        st.toast("✅ Your preferences have been updated!", icon="🧠")
-    except (json.JSONDecodeError, Exception) as e:
-        st.warning(f"Could not update preferences due to an AI response error. Raw error: {e}")
-        print(f"Failed to parse preference update: {ai_response.content}")
-    
+        knowledge_base.update_user_preferences(user_id, validated_prefs.model_dump())
+        knowledge_base.mark_feedback_processed([event["_id"] for event in events])
+    except Exception:
+        logger.exception("Preference reflection failed for user %s (LLM reply: %r)", user_id, ai_content)
+        if events:
+            try:
+                knowledge_base.record_feedback_failure(events, FEEDBACK_MAX_ATTEMPTS, FEEDBACK_RETRY_BASE_SECONDS)
+            except Exception:
+                logger.exception("Could not record the failed reflection for user %s", user_id)
@@ -1,53 +1,297 @@
 # main.py
 
 import streamlit as st
-import folium
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from streamlit_js_eval import get_geolocation
 import numpy as np
 from dotenv import load_dotenv
-import traceback
+import logging
 import os
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-from sentence_transformers import SentenceTransformer
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.output_parsers import PydanticOutputParser
-
-from app import services, models, knowledge_base
+from app import services, models, knowledge_base, geo, narrative_cache
 
 # --- 1. INITIALIZATION & PAGE CONFIG ---
 st.set_page_config(page_title="Hometown Atlas", page_icon="🗺️", layout="wide", initial_sidebar_state="expanded")
 load_dotenv()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+# One flash model serves narrative, chat and reflection; the FAISS index was built with MiniLM embeddings.
+LLM_MODEL_NAME = "gemini-2.5-flash"
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# The chat prompt carries the last few turns verbatim and a running summary of everything older.
+CHAT_RECENT_MESSAGES = 8
+CHAT_SUMMARY_TRIGGER = 16
+
+TRAVEL_MODE_OPTIONS = {"Walking": "foot-walking", "Driving": "driving-car"}
+DEFAULT_JOURNEY_QUERY = "A detailed and engaging travel narrative for a {mode} journey to the destination."
+
+# Nsukka town centre, used as the map centre and as the fallback start when geolocation is unavailable.
+DEFAULT_LOCATION = (6.855, 7.38)
+# Browser location lookups tried before giving up and offering DEFAULT_LOCATION.
+GEO_MAX_ATTEMPTS = 3
+
+# The models live in st.cache_resource, so one instance is shared by every session in the process.
+# Their heavy libraries are imported inside the getters, keeping them off the cold-start path.
+def _gemini_client(**kwargs):
+    """Builds a Gemini chat client with the app's shared settings."""
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model=LLM_MODEL_NAME, transport="rest", timeout=120, **kwargs)
+
+@st.cache_resource(show_spinner="Warming up the AI guide...")
+def get_llm():
+    """Returns the shared plain-text Gemini client used for chat."""
+    return _gemini_client()
+
+@st.cache_resource(show_spinner="Warming up the AI guide...")
+def get_narrative_llm():
+    """Returns the shared Gemini client whose output is constrained to the JourneyNarrative schema."""
+    return _gemini_client(
+        response_mime_type="application/json",
+        response_schema=models.JourneyNarrative.model_json_schema()
+    )
+
+@st.cache_resource(show_spinner="Warming up the AI guide...")
+def get_reflection_llm():
+    """Returns the shared Gemini client whose output is constrained to the UserPreferences schema."""
+    return _gemini_client(
+        response_mime_type="application/json",
+        response_schema=models.UserPreferences.model_json_schema()
+    )
+
+@st.cache_resource(show_spinner="Warming up the AI guide...")
+def get_embedding_model():
+    """
+    Loads the sentence embedding model once per process, on the GPU (in FP16) when one is available.
+    EMBEDDING_BACKEND=onnx loads the int8-quantized ONNX export shipped with the model for faster CPU encoding.
+    """
+    from sentence_transformers import SentenceTransformer
+    if os.getenv("EMBEDDING_BACKEND", "torch") == "onnx":
+        return SentenceTransformer(
+            EMBEDDING_MODEL_NAME,
+            device="cpu",
+            backend="onnx",
+            model_kwargs={"file_name": "onnx/model_qint8_avx512_vnni.onnx"}
+        )
+
+    import torch
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cpu":
+        # One short query per journey gains little from many threads, and concurrent sessions would oversubscribe the cores.
+        torch.set_num_threads(int(os.getenv("EMBED_THREADS", "4")))
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # Can only be set before torch starts its first parallel work.
+    logger.info("Loading embedding model %s on %s", EMBEDDING_MODEL_NAME, device)
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
+    model.eval()
+    if device == "cuda":
+        # FP16 halves the weights moved per forward pass; FAISS still gets float32 after the cast at search time.
+        model.half()
+    return model
+
+@st.cache_resource
+def get_parser():
+    """Returns the shared fallback parser for narrative responses."""
+    from langchain.output_parsers import PydanticOutputParser
+    return PydanticOutputParser(pydantic_object=models.JourneyNarrative)
 
 def initialize_models():
     """
-    Checks if the AI models are in the session state and initializes them if not.
+    Warms up the Gemini clients so a missing key fails fast with a clear message.
+    The getters show their own spinner only while actually loading, so warm reruns draw nothing.
+    The embedder (and torch) load on the first journey instead of on every cold start.
     """
-    if "llm" not in st.session_state:
-        with st.spinner("Warming up the AI guide..."):
-            try:
-                st.session_state.llm = ChatGoogleGenerativeAI(
-                    model="gemini-2.5-flash",
-                    transport="rest",
-                    timeout=120
-                )
-                st.session_state.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-                st.session_state.parser = PydanticOutputParser(pydantic_object=models.JourneyNarrative)
-            except Exception as e:
-                st.error(f"Fatal Error: Could not initialize AI models. Please check your API keys and environment. Error: {e}")
-                st.stop()
+    try:
+        get_llm()
+        get_narrative_llm()
+        get_reflection_llm()
+    except Exception as e:
+        st.error(f"Fatal Error: Could not initialize AI models. Please check your API keys and environment. Error: {e}")
+        st.stop()
 
 initialize_models()
 
+@st.cache_resource(show_spinner="Warming up the knowledge base...")
+def warm_up_retrieval():
+    """
+    Loads the embedder and FAISS index and pre-embeds the journey query for every travel mode,
+    so the first journey skips model load and encoding entirely. Enabled with RAG_WARMUP=1.
+    """
+    embedding_model = get_embedding_model()
+    for mode_label in TRAVEL_MODE_OPTIONS:
+        query = DEFAULT_JOURNEY_QUERY.format(mode=mode_label.lower())
+        knowledge_base.search_knowledge_base(services.embed_query(embedding_model, query))
+    return True
+
+if os.getenv("RAG_WARMUP", "0") == "1":
+    warm_up_retrieval()
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Starts one long-lived event loop on a background thread, shared by every session,
+    so journey creation doesn't build and tear down a loop on each click.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="journey-event-loop", daemon=True).start()
+    return loop
+
+# Bump when RouteSummary or the ORS extraction changes, so routes persisted by an older build aren't reused.
+ROUTE_CACHE_VERSION = 1
+
+class NoRouteFound(Exception):
+    """Raised inside the route cache for an unreachable destination, so the miss isn't persisted."""
+
+@st.cache_data(persist="disk", max_entries=1024, show_spinner=False)
+def _cached_route(start_lon: float, start_lat: float, end_lon: float, end_lat: float, travel_mode: str, cache_version: int):
+    """
+    Memoizes ORS routes on the 5-decimal (~1 m) rounded coordinates and travel mode,
+    so repeat journeys and reruns reuse the route instead of calling the provider again.
+    Persisted to disk so the table survives restarts; Streamlit ignores ttl on persisted caches,
+    and street geometry between two fixed points is effectively stable, so entries are bounded by count only.
+    """
+    route_data = services.get_route_from_ors(start_lon, start_lat, end_lon, end_lat, travel_mode=travel_mode)
+    if route_data is None:
+        raise NoRouteFound()
+    return route_data
+
+def cached_route(start_lon: float, start_lat: float, end_lon: float, end_lat: float, travel_mode: str) -> Optional[models.RouteSummary]:
+    """
+    Returns the cached route, or None if ORS found no route.
+    Streamlit doesn't cache a raised exception, so "no route" is asked again next time rather than kept forever.
+    """
+    try:
+        return _cached_route(start_lon, start_lat, end_lon, end_lat, travel_mode, ROUTE_CACHE_VERSION)
+    except NoRouteFound:
+        return None
+
+@st.cache_resource
+def get_feedback_executor() -> ThreadPoolExecutor:
+    """
+    Runs preference reflection in the background so the feedback buttons return instantly.
+    A single worker keeps two reflections from claiming the same pending events.
+    """
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="feedback")
+
+# Feedback is reflected in batches: right away once a user has this many pending events,
+# otherwise by the background flusher on its next tick.
+FEEDBACK_FLUSH_SIZE = 8
+FEEDBACK_FLUSH_INTERVAL = 30
+
+@st.cache_resource
+def get_reflections_in_flight() -> tuple:
+    """The users with a reflection queued or running, and the lock guarding that set."""
+    return set(), threading.Lock()
+
+def submit_reflection(llm, user_id: str):
+    """
+    Queues a batch reflection for a user unless one is already queued or running,
+    so a slow reflection can't pile duplicate jobs onto the single worker.
+    """
+    in_flight, lock = get_reflections_in_flight()
+    with lock:
+        if user_id in in_flight:
+            return
+        in_flight.add(user_id)
+
+    def _done(future):
+        with lock:
+            in_flight.discard(user_id)
+        if future.exception() is not None:
+            logger.error("Preference reflection crashed for user %s", user_id, exc_info=future.exception())
+
+    get_feedback_executor().submit(services.reflect_on_pending_feedback, llm, user_id).add_done_callback(_done)
+
+def _flush_feedback_forever(llm):
+    """Every FEEDBACK_FLUSH_INTERVAL seconds, queues a batch reflection for each user with feedback due."""
+    while True:
+        time.sleep(FEEDBACK_FLUSH_INTERVAL)
+        try:
+            for user_id in knowledge_base.get_users_with_pending_feedback():
+                submit_reflection(llm, user_id)
+        except Exception:
+            logger.exception("Feedback flush failed")
+
+@st.cache_resource
+def get_feedback_flusher(_llm) -> threading.Thread:
+    """Starts the periodic feedback flusher once per process."""
+    flusher = threading.Thread(target=_flush_feedback_forever, args=(_llm,), name="feedback-flusher", daemon=True)
+    flusher.start()
+    return flusher
+
+get_feedback_flusher(get_reflection_llm())
+
+def record_journey_feedback(original_query: str, journey_title: str, user_feedback: str):
+    """
+    Queues a like or dislike for batch reflection, reflecting right away once
+    FEEDBACK_FLUSH_SIZE events are pending, and thanks the user.
+    """
+    reflection_request = models.ReflectionRequest(
+        user_id=st.session_state.user_id, original_query=original_query,
+        journey_title=journey_title, user_feedback=user_feedback
+    )
+    knowledge_base.append_feedback(reflection_request.model_dump())
+    if knowledge_base.count_pending_feedback(st.session_state.user_id) >= FEEDBACK_FLUSH_SIZE:
+        submit_reflection(get_reflection_llm(), st.session_state.user_id)
+    st.toast("Thanks! I'll use this to tailor your next journey.", icon="🧠")
+
+def _with_script_ctx(ctx, func, *args, **kwargs):
+    """Runs func on a worker thread with the calling session's Streamlit context attached."""
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return func(*args, **kwargs)
+
+@st.cache_resource
+def get_narrative_cache() -> narrative_cache.NarrativeCache:
+    """Process-wide cache of finished narratives, shared by every session."""
+    return narrative_cache.NarrativeCache(capacity=1000, ttl=3600)
+
+def cached_narrative(request: models.JourneyRequest, **narrative_kwargs) -> models.JourneyNarrative:
+    """
+    Returns the narrative for an identical (normalized) query, destination, city and user if one
+    was generated within the last hour, and otherwise generates and stores it.
+    """
+    cache = get_narrative_cache()
+    key = (narrative_cache.normalize_query(request.query), request.destination_poi_id, request.city, request.user_id)
+    narrative = cache.get(key)
+    if narrative is None:
+        narrative = services.generate_narrative_with_rag(request=request, **narrative_kwargs)
+        cache.set(key, narrative)
+    return narrative
+
+async def build_journey(ctx, route_kwargs: dict, narrative_kwargs: dict):
+    """
+    Fetches the route and generates the narrative concurrently.
+    Neither depends on the other, so the wait is the slower call rather than their sum.
+    """
+    return await asyncio.gather(
+        asyncio.to_thread(_with_script_ctx, ctx, cached_route, **route_kwargs),
+        asyncio.to_thread(_with_script_ctx, ctx, cached_narrative, **narrative_kwargs),
+    )
+
 # --- 2. SESSION STATE MANAGEMENT ---
 if "start_location" not in st.session_state: st.session_state.start_location = None
+if "geo_attempts" not in st.session_state: st.session_state.geo_attempts = 0
 if "selected_city" not in st.session_state: st.session_state.selected_city = "Nsukka"
 if "selected_destination_id" not in st.session_state: st.session_state.selected_destination_id = None
+if "selected_destination_poi" not in st.session_state: st.session_state.selected_destination_poi = None
 if "journey_narrative" not in st.session_state: st.session_state.journey_narrative = None
-if "journey_route_data" not in st.session_state: st.session_state.journey_route_data = None
+# The route is a frozen RouteSummary; session state holds it by reference, so reruns never refetch or copy it.
+if "journey_route" not in st.session_state: st.session_state.journey_route = None
+if "last_journey_key" not in st.session_state: st.session_state.last_journey_key = None
 if "destination_poi_only" not in st.session_state: st.session_state.destination_poi_only = None
 if "messages" not in st.session_state:
-    st.session_state.messages = [{"role": "assistant", "content": "Welcome! I am your personal tour guide. Once you create a journey, you can ask me anything about it here."}]
+    st.session_state.messages = [{"role": "assistant", "content": "Welcome! I am your personal tour guide. Once you create a journey, you can ask me anything about it here.", "internal": True}]
+if "history_summary" not in st.session_state: st.session_state.history_summary = ""
+if "summarized_count" not in st.session_state: st.session_state.summarized_count = 0
 if "user_id" not in st.session_state: st.session_state.user_id = "hackathon_user_01"
 
 # --- 3. SIDEBAR (CONTROLS & FILTERS) ---
@@ -58,9 +302,8 @@ with st.sidebar:
 
     st.subheader("1. Select Your Journey")
     
-    travel_mode_options = {"Walking": "foot-walking", "Driving": "driving-car"}
-    selected_mode_label = st.selectbox("Travel Mode:", options=list(travel_mode_options.keys()))
-    selected_mode_api = travel_mode_options[selected_mode_label]
+    selected_mode_label = st.selectbox("Travel Mode:", options=list(TRAVEL_MODE_OPTIONS.keys()))
+    selected_mode_api = TRAVEL_MODE_OPTIONS[selected_mode_label]
 
     st.session_state.selected_city = st.selectbox("Select City/Region:", ("Nsukka", "Enugu", "Addis Ababa", "Nairobi", "Lagos", "Kenya", "Ethiopia"))
 
@@ -72,7 +315,8 @@ with st.sidebar:
     selected_tags = st.multiselect("Interests / Tags:", options=available_tags)
 
     poi_list = knowledge_base.get_pois_by_city(st.session_state.selected_city, selected_tags, selected_budget)
-    poi_choices_dict = {poi['name']: poi['_id'] for poi in poi_list}
+    # The list already holds full POI documents, so the chosen destination needs no second lookup.
+    poi_choices_dict = {poi['name']: poi for poi in poi_list}
 
     if poi_list:
         destination_name = st.selectbox(
@@ -81,117 +325,185 @@ with st.sidebar:
             key="destination_select",
             index=0
         )
-        if destination_name:
-            st.session_state.selected_destination_id = poi_choices_dict.get(destination_name)
-        else:
-            st.session_state.selected_destination_id = None
+        st.session_state.selected_destination_poi = poi_choices_dict.get(destination_name) if destination_name else None
     else:
         st.warning("No destinations match your filters.")
-        st.session_state.selected_destination_id = None
+        st.session_state.selected_destination_poi = None
+
+    st.session_state.selected_destination_id = (
+        st.session_state.selected_destination_poi['_id'] if st.session_state.selected_destination_poi else None
+    )
 
     st.divider()
     create_journey_button = st.button("Create My Journey", type="primary", use_container_width=True)
 
 # --- 4. MAIN PANEL (UI TABS) ---
-tab1, tab2 = st.tabs(["📍 Your Journey", "💬 Talk with the Guide"])
 
-with tab1:
-    st.subheader("🗺️ Hometown Atlas Interactive Map")
+def _route_hash(points) -> str:
+    """Short content hash of a route geometry, used as the map cache key in place of the points themselves."""
+    return hashlib.blake2b(np.asarray(points, dtype=np.float64).tobytes(), digest_size=16).hexdigest()
 
-    if st.session_state.start_location is None:
-        location = get_geolocation()
-        if location:
-            st.session_state.start_location = {'lat': location['coords']['latitude'], 'lng': location['coords']['longitude']}
-            st.rerun()
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_map_html(start: Optional[tuple], dest: Optional[tuple], route_hash: Optional[str], _route_points=None) -> str:
+    """
+    Builds the journey map and returns its rendered HTML.
+    Keyed on the start, destination and route hash, so reruns from the chat tab or other widgets
+    reuse the serialized map instead of rebuilding markers and the polyline.
+    """
+    import folium
 
-    map_center = [st.session_state.start_location['lat'], st.session_state.start_location['lng']] if st.session_state.start_location else [6.855, 7.38]
+    map_center = list(start) if start else list(DEFAULT_LOCATION)
     m = folium.Map(location=map_center, zoom_start=14)
 
-    if st.session_state.start_location:
-        folium.Marker(
-            [st.session_state.start_location['lat'], st.session_state.start_location['lng']],
-            popup="Your Location", tooltip="Your Location", icon=folium.Icon(color="blue", icon="user")
-        ).add_to(m)
+    if start:
+        folium.Marker(list(start), popup="Your Location", tooltip="Your Location", icon=folium.Icon(color="blue", icon="user")).add_to(m)
+
+    if dest:
+        dest_lat, dest_lon, dest_name = dest
+        folium.Marker([dest_lat, dest_lon], popup=dest_name, tooltip=dest_name, icon=folium.Icon(color="red", icon="flag")).add_to(m)
+
+    if route_hash and _route_points is not None:
+        # Long routes are thinned to a visually identical line before they are serialized into the page.
+        # ORS returns [lon, lat]; Folium wants [lat, lon]. One strided flip instead of a tuple per vertex.
+        swapped_points = geo.simplify_polyline(_route_points)[:, ::-1]
+        folium.PolyLine(swapped_points.tolist(), color="red", weight=5, opacity=0.8).add_to(m)
+        m.fit_bounds([swapped_points.min(axis=0).tolist(), swapped_points.max(axis=0).tolist()])
+
+    return m.get_root().render()
+
+@st.fragment
+def render_map(route_data: Optional[models.RouteSummary]):
+    """
+    Displays the journey map from session state and the current run's route.
+    As a fragment, geolocation updates rerun only this block, not the whole app.
+    """
+    # The browser's answer arrives as a fragment rerun, and the map below picks it up in the same pass.
+    # The component asks the browser once per mount and then keeps returning that answer, so a denied
+    # or failed lookup is retried by mounting a fresh component under the next attempt's key.
+    if st.session_state.start_location is None and st.session_state.geo_attempts < GEO_MAX_ATTEMPTS:
+        location = get_geolocation(component_key=f"geolocation_{st.session_state.geo_attempts}")
+        if location and 'coords' in location:
+            st.session_state.start_location = {'lat': location['coords']['latitude'], 'lng': location['coords']['longitude']}
+        elif location:
+            st.session_state.geo_attempts += 1
+            if st.session_state.geo_attempts < GEO_MAX_ATTEMPTS:
+                get_geolocation(component_key=f"geolocation_{st.session_state.geo_attempts}")
+
+    if st.session_state.start_location is None:
+        if st.button("Use default location", key="use_default_location"):
+            st.session_state.start_location = {'lat': DEFAULT_LOCATION[0], 'lng': DEFAULT_LOCATION[1]}
+
+    start = (st.session_state.start_location['lat'], st.session_state.start_location['lng']) if st.session_state.start_location else None
+    dest, route_hash, route_points = None, None, None
+
+    if st.session_state.destination_poi_only:
+        dest_poi = st.session_state.destination_poi_only
+    elif route_data and st.session_state.journey_narrative:
+        dest_poi = st.session_state.selected_destination_poi
+        if dest_poi:
+            route_points = route_data.points
+            route_hash = _route_hash(route_points)
+    else:
+        dest_poi = None
+
+    if dest_poi:
+        dest = (dest_poi['location']['coordinates'][1], dest_poi['location']['coordinates'][0], dest_poi['name'])
+
+    # The map is display-only, so static HTML replaces the st_folium round-trip component.
+    components.html(build_map_html(start, dest, route_hash, _route_points=route_points), height=350)
+
+tab1, tab2 = st.tabs(["📍 Your Journey", "💬 Talk with the Guide"])
+
+with tab1:
+    st.subheader("🗺️ Hometown Atlas Interactive Map")
 
     if create_journey_button:
-        default_journey_query = f"A detailed and engaging travel narrative for a {selected_mode_label.lower()} journey to the destination."
+        default_journey_query = DEFAULT_JOURNEY_QUERY.format(mode=selected_mode_label.lower())
+        # Identifies the journey being asked for, so a repeat click for the one already shown does no work.
+        journey_key = (
+            st.session_state.user_id, st.session_state.selected_destination_id, selected_mode_api, default_journey_query,
+            tuple(np.round([st.session_state.start_location['lat'], st.session_state.start_location['lng']], 5).tolist())
+            if st.session_state.start_location else None
+        )
 
         if not st.session_state.selected_destination_id:
             st.error("Please choose a destination from the sidebar.")
         elif not st.session_state.start_location:
-            st.error("Could not determine your starting location. Please allow location access and refresh.")
+            st.error("Could not determine your starting location. Please allow location access, or click 'Use default location' above the map.")
+        # Only reads session state, so unlike the fetch below it cannot fail and needs no try.
+        elif (journey_key == st.session_state.last_journey_key and st.session_state.journey_narrative
+              and st.session_state.journey_route is not None):
+            st.info("This journey is already on the map below.")
         else:
+            # The narrative streams into this placeholder while the route is still being fetched.
+            narrative_preview = st.empty()
+
+            def show_partial_narrative(partial: dict):
+                narrative_preview.markdown(f"### {partial.get('title', '')}\n\n{partial.get('narrative', '')}")
+
             with st.spinner("Crafting your personalized journey... This may take a moment."):
                 try:
-                    start_lat = round(st.session_state.start_location['lat'], 5)
-                    start_lon = round(st.session_state.start_location['lng'], 5)
-                    dest_poi = knowledge_base.get_poi_by_id(st.session_state.selected_destination_id)
-                    end_lat = round(dest_poi['location']['coordinates'][1], 5)
-                    end_lon = round(dest_poi['location']['coordinates'][0], 5)
-
-                    route_data = services.get_route_from_ors(start_lon, start_lat, end_lon, end_lat, travel_mode=selected_mode_api)
+                    dest_poi = st.session_state.selected_destination_poi
+                    # Quantize all four coordinates in one pass; .tolist() hands back plain floats for the route cache key.
+                    start_lat, start_lon, end_lat, end_lon = np.round([
+                        st.session_state.start_location['lat'], st.session_state.start_location['lng'],
+                        dest_poi['location']['coordinates'][1], dest_poi['location']['coordinates'][0]
+                    ], 5).tolist()
+
+                    # Every field comes from app state already in the right type, so validation is skipped.
+                    request = models.JourneyRequest.model_construct(
+                        user_id=st.session_state.user_id, latitude=start_lat, longitude=start_lon,
+                        city=st.session_state.selected_city, query=default_journey_query,
+                        destination_poi_id=str(st.session_state.selected_destination_id)
+                    )
+                    route_kwargs = dict(
+                        start_lon=start_lon, start_lat=start_lat, end_lon=end_lon, end_lat=end_lat,
+                        travel_mode=selected_mode_api
+                    )
+                    route_data, narrative = asyncio.run_coroutine_threadsafe(
+                        build_journey(
+                            get_script_run_ctx(),
+                            route_kwargs=route_kwargs,
+                            narrative_kwargs=dict(
+                                llm=get_narrative_llm(),
+                                embedding_model=get_embedding_model(),
+                                parser=get_parser(),
+                                request=request,
+                                destination_name=dest_poi['name'],
+                                on_partial=show_partial_narrative
+                            )
+                        ),
+                        get_event_loop()
+                    ).result()
 
                     if route_data is None:
                         st.warning(f"Could not find a {selected_mode_label.lower()} route to this destination. The location may be inaccessible by this mode of transport.")
-                        st.session_state.journey_narrative = None
-                        st.session_state.journey_route_data = None
-                        st.session_state.destination_poi_only = dest_poi
-                        st.rerun()
-                    else:
-                        request = models.JourneyRequest(
-                            user_id=st.session_state.user_id, latitude=start_lat, longitude=start_lon,
-                            city=st.session_state.selected_city, query=default_journey_query,
-                            destination_poi_id=st.session_state.selected_destination_id
+                        st.session_state.update(
+                            journey_narrative=None, journey_route=None, destination_poi_only=dest_poi, last_journey_key=None
                         )
-                        narrative = services.generate_narrative_with_rag(
-                            llm=st.session_state.llm,
-                            embedding_model=st.session_state.embedding_model,
-                            parser=st.session_state.parser,
-                            request=request,
-                            destination_name=dest_poi['name']
+                    else:
+                        st.session_state.update(
+                            journey_narrative=narrative, journey_route=route_data, destination_poi_only=None,
+                            last_journey_key=journey_key
                         )
-                        st.session_state.journey_narrative = narrative
-                        st.session_state.journey_route_data = route_data
-                        st.session_state.destination_poi_only = None
-                        st.rerun()
 
                 except Exception as e:
                     st.error(f"An error occurred while creating your journey: {e}")
-                    traceback.print_exc()
-
-    if st.session_state.destination_poi_only:
-        dest_poi = st.session_state.destination_poi_only
-        if dest_poi:
-             folium.Marker(
-                [dest_poi['location']['coordinates'][1], dest_poi['location']['coordinates'][0]],
-                popup=dest_poi['name'], tooltip=dest_poi['name'], icon=folium.Icon(color="red", icon="flag")
-            ).add_to(m)
+                    logger.exception("Journey creation failed")
+            narrative_preview.empty()
 
-    elif st.session_state.journey_route_data and st.session_state.journey_narrative:
-        dest_poi = knowledge_base.get_poi_by_id(st.session_state.selected_destination_id)
-        if dest_poi:
-            folium.Marker(
-                [dest_poi['location']['coordinates'][1], dest_poi['location']['coordinates'][0]],
-                popup=dest_poi['name'], tooltip=dest_poi['name'], icon=folium.Icon(color="red", icon="flag")
-            ).add_to(m)
-            points = st.session_state.journey_route_data['points']
-            swapped_points = [(p[1], p[0]) for p in points]
-            folium.PolyLine(swapped_points, color="red", weight=5, opacity=0.8).add_to(m)
-            m.fit_bounds(swapped_points)
-
-    st_folium(m, width='100%', height=350)
+    # Read once, after the handler above may have replaced it, and shared by the map and the metrics.
+    route_data = st.session_state.journey_route
+    render_map(route_data)
     st.divider()
 
-    if st.session_state.journey_narrative and st.session_state.journey_route_data:
+    if st.session_state.journey_narrative and route_data:
         narrative = st.session_state.journey_narrative
-        route_data = st.session_state.journey_route_data
         st.subheader("Your Generated Journey")
         metric_col1, metric_col2 = st.columns(2)
-        duration_min = route_data['duration'] / 60
-        distance_km = route_data['distance'] / 1000
         icon = "🚶‍♀️" if selected_mode_api == "foot-walking" else "🚗"
-        metric_col1.metric(label=f"{icon} Est. Travel Time", value=f"{duration_min:.0f} min")
-        metric_col2.metric(label="📏 Distance", value=f"{distance_km:.2f} km")
+        metric_col1.metric(label=f"{icon} Est. Travel Time", value=f"{route_data.duration_min:.0f} min")
+        metric_col2.metric(label="📏 Distance", value=f"{route_data.distance_km:.2f} km")
         st.markdown(f"### {narrative.title}")
         st.markdown(f"*{narrative.location_awareness}*")
         st.markdown(narrative.narrative)
@@ -205,27 +517,22 @@ with tab1:
 
         with feedback_col1:
             if st.button("👍 Yes", key="like_journey", use_container_width=True):
-                with st.spinner("Learning from your feedback..."):
-                    reflection_request = models.ReflectionRequest(
-                        user_id=st.session_state.user_id, original_query=feedback_query,
-                        journey_title=narrative.title, user_feedback="liked"
-                    )
-                    services.reflect_and_update_preferences(st.session_state.llm, reflection_request)
+                record_journey_feedback(feedback_query, narrative.title, "liked")
         
         with feedback_col2:
             if st.button("👎 No", key="dislike_journey", use_container_width=True):
-                with st.spinner("Learning from your feedback..."):
-                    reflection_request = models.ReflectionRequest(
-                        user_id=st.session_state.user_id, original_query=feedback_query,
-                        journey_title=narrative.title, user_feedback="disliked"
-                    )
-                    services.reflect_and_update_preferences(st.session_state.llm, reflection_request)
+                record_journey_feedback(feedback_query, narrative.title, "disliked")
     else:
         if not st.session_state.destination_poi_only:
             st.info("To begin, select your travel mode and destination in the sidebar, then click 'Create My Journey'.")
 
 # --- FIX: Restore the chat interface logic ---
-with tab2:
+@st.fragment
+def chat_panel():
+    """
+    Renders the guide chat.
+    As a fragment, sending a message reruns only the chat, not the sidebar, map and journey above.
+    """
     st.subheader("Talk with the Tourist Guide")
 
     for message in st.session_state.messages:
@@ -238,27 +545,47 @@ with tab2:
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                try:
-                    if st.session_state.journey_narrative:
-                        conversation_history = " ".join([m['content'] for m in st.session_state.messages])
-                        dest_poi = knowledge_base.get_poi_by_id(st.session_state.selected_destination_id)
-
-                        response_content = services.generate_chat_response(
-                            llm=st.session_state.llm,
-                            user_id=st.session_state.user_id, city=st.session_state.selected_city,
-                            destination_name=dest_poi['name'], journey_narrative=st.session_state.journey_narrative,
-                            conversation_history=conversation_history
+            try:
+                if st.session_state.journey_narrative:
+                    # Once enough turns pile up, the older ones are folded into the summary so the prompt stays bounded.
+                    # Displayed messages are kept; summarized_count is the message index the summary reaches.
+                    # Canned app messages (welcome, prompts, errors) are flagged internal and never reach the LLM.
+                    pending = [
+                        (i, m) for i, m in enumerate(st.session_state.messages)
+                        if i >= st.session_state.summarized_count and not m.get("internal")
+                    ]
+                    if len(pending) > CHAT_SUMMARY_TRIGGER:
+                        st.session_state.history_summary = services.summarize_history(
+                            get_llm(), st.session_state.history_summary, [m for _, m in pending[:-CHAT_RECENT_MESSAGES]]
                         )
-                        st.markdown(response_content)
-                        st.session_state.messages.append({"role": "assistant", "content": response_content})
-                    else:
-                        st.warning("Please create a journey first before asking questions.")
-                        st.session_state.messages.append({"role": "assistant", "content": "I can only answer questions about a journey after you've created one. Please go to the 'Your Journey' tab and click 'Create My Journey'."})
+                        st.session_state.summarized_count = pending[-CHAT_RECENT_MESSAGES][0]
+                        pending = pending[-CHAT_RECENT_MESSAGES:]
+
+                    # Role prefixes let the model tell the traveller's questions from its own earlier answers.
+                    history_parts = [f"{m['role']}: {m['content']}" for _, m in pending]
+                    conversation_history = (
+                        f"Summary so far: {st.session_state.history_summary or 'None'}\nRecent:\n"
+                        + "\n".join(history_parts)
+                    )
+                    dest_poi = st.session_state.selected_destination_poi
+
+                    # Tokens render as they arrive, so the wait is time-to-first-token rather than the full reply.
+                    response_content = st.write_stream(services.stream_chat_response(
+                        llm=get_llm(),
+                        user_id=st.session_state.user_id, city=st.session_state.selected_city,
+                        destination_name=dest_poi['name'], journey_narrative=st.session_state.journey_narrative,
+                        conversation_history=conversation_history
+                    ))
+                    st.session_state.messages.append({"role": "assistant", "content": response_content})
+                else:
+                    st.warning("Please create a journey first before asking questions.")
+                    st.session_state.messages.append({"role": "assistant", "content": "I can only answer questions about a journey after you've created one. Please go to the 'Your Journey' tab and click 'Create My Journey'.", "internal": True})
 
-                except Exception as e:
-                    error_message = f"I'm sorry, I encountered an error: {e}"
-                    st.error(error_message)
-                    st.session_state.messages.append({"role": "assistant", "content": error_message})
-                    traceback.print_exc()
-    
+            except Exception as e:
+                error_message = f"I'm sorry, I encountered an error: {e}"
+                st.error(error_message)
+                st.session_state.messages.append({"role": "assistant", "content": error_message, "internal": True})
+                logger.exception("Chat response failed")
+
+with tab2:
+    chat_panel()